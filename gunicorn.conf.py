@@ -0,0 +1,9 @@
+import multiprocessing
+import os
+
+# O dev server do Werkzeug (python main.py) atende um request por vez; em
+# produção o gunicorn com workers gthread permite requests concorrentes e
+# multiplexa os pipelines do Redis. O bind fica por conta da env PORT.
+workers = int(os.getenv("WEB_CONCURRENCY", 2 * multiprocessing.cpu_count() + 1))
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+worker_class = "gthread"
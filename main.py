@@ -1,10 +1,19 @@
-from flask import Flask, request, jsonify
-import redis
+from flask import Flask, request
+import redis.asyncio
 import os
+import ast
+import json
+import orjson
+import base64
+import pickle
+import time
 from dotenv import load_dotenv
+import numpy as np
 import pandas as pd
 from sklearn.ensemble import IsolationForest
+import asyncio
 import concurrent.futures
+import threading
 from flask_cors import CORS
 import logging
 
@@ -14,78 +23,270 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 CORS(app)
-load_dotenv()
 
-# Configuração do cliente Redis
-redis_url = os.getenv("REDIS_URL")
-redis_client = redis.Redis.from_url(redis_url, decode_responses=True)
+
+def json_response(payload, status=200):
+    # orjson.dumps é bem mais rápido que o json do stdlib usado pelo jsonify
+    return app.response_class(
+        orjson.dumps(payload), status=status, mimetype="application/json"
+    )
+
+
+# A URL do Redis é lida sob demanda para não depender do .env no import.
+# Cada inicialização preguiçosa tem seu lock: com workers gthread, dois
+# primeiros requests simultâneos criariam (e vazariam) recursos duplicados.
+_redis_url = None
+_redis_url_lock = threading.Lock()
+
+
+def get_redis_url():
+    global _redis_url
+    if _redis_url is None:
+        with _redis_url_lock:
+            if _redis_url is None:
+                load_dotenv()
+                _redis_url = os.getenv("REDIS_URL")
+    return _redis_url
+
+
+# Cliente síncrono com pool de conexões, um por processo, para as consultas
+# pontuais (ZCARD, cache de modelo). O cliente assíncrono fica restrito aos
+# lotes de fetch/save e é criado por request, porque o Flask dá a cada view
+# async seu próprio event loop e as conexões do redis.asyncio são presas a ele.
+_redis_client = None
+_redis_client_lock = threading.Lock()
+
+
+def get_redis_client():
+    global _redis_client
+    if _redis_client is None:
+        with _redis_client_lock:
+            if _redis_client is None:
+                pool = redis.BlockingConnectionPool.from_url(
+                    get_redis_url(), max_connections=32, decode_responses=True
+                )
+                _redis_client = redis.Redis(connection_pool=pool)
+    return _redis_client
+
+
+# Pool de processos persistente para os fits do Isolation Forest; criado sob
+# demanda para não pagar o fork dos workers em todo request.
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def get_process_pool():
+    global _process_pool
+    if _process_pool is None:
+        with _process_pool_lock:
+            if _process_pool is None:
+                _process_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=os.cpu_count()
+                )
+    return _process_pool
+
+
+MIN_PLAYERS_REQUIRED = 10
+
+# Tamanho máximo do histórico mantido por nível (ring buffer no Redis)
+MAX_PLAYERS_PER_LEVEL = 512
+
+# TTL dos payloads de jogador; o índice é aparado pela mesma idade para não
+# acumular membros fantasmas apontando para chaves já expiradas.
+PLAYER_TTL = 7 * 24 * 60 * 60  # 7 dias em segundos
+
+# Cache do modelo ajustado no Redis (único, compartilhado entre níveis)
+MODEL_CACHE_KEY = "model:levels"
+MODEL_CACHE_TTL = 60 * 60  # 1 hora em segundos
+MODEL_REFIT_GROWTH = 1.2  # reajusta quando a base cresce mais de 20%
+
+# Métricas usadas como features do Isolation Forest
+FEATURE_COLS = [
+    "assists",
+    "clutches",
+    "deaths",
+    "firstKills",
+    "headshots",
+    "kddiff",
+    "kdr",
+    "adr",
+]
+
+# Mapeia as colunas aninhadas do payload para os nomes planos usados aqui
+PROFILE_COLUMNS = {
+    "metrics.level": "level",
+    **{f"metrics.stats.{k}": k for k in FEATURE_COLS},
+}
 
 
 @app.route("/analyze", methods=["POST"])
-def analyze_metrics():
+async def analyze_metrics():
     logger.info("Recebida requisição para /analyze")
-    data = request.get_json()
-    if not data or "profiles" not in data:
+    try:
+        data = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict) or "profiles" not in data:
         logger.warning("Nenhum dado fornecido ou chave 'profiles' ausente")
-        return jsonify({"error": "No data provided"}), 400
+        return json_response({"error": "No data provided"}, status=400)
 
     try:
         level_dict = process_profiles(data["profiles"])
-        risk_label = calculate_and_store_risk(level_dict)
+        risk_label = await calculate_and_store_risk(level_dict)
         logger.info(f"Risco calculado: {risk_label}")
-        return jsonify({"risk": risk_label})
+        return json_response({"risk": risk_label})
     except Exception as e:
         logger.error(f"Erro durante a análise: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}, status=500)
 
 
 def process_profiles(profiles):
     logger.info("Processando perfis")
-    level_dict = {}
-    for profile in profiles:
-        data = extract_and_process_profile_data(profile)
-        if data:
-            level = data["level"]
-            if level not in level_dict:
-                level_dict[level] = []
-            level_dict[level].append(data)
+    if not profiles:
+        return {}
+
+    df = (
+        pd.json_normalize(profiles)
+        .reindex(columns=list(PROFILE_COLUMNS))
+        .rename(columns=PROFILE_COLUMNS)
+    )
+    df[FEATURE_COLS] = df[FEATURE_COLS].fillna(0)
+    # Perfis sem nível não têm onde ser agrupados; o dropna também evita que o
+    # NaN promova a coluna para float e mude as chaves do Redis (5 -> 5.0).
+    df = df.dropna(subset=["level"])
+    df["level"] = df["level"].convert_dtypes()
+
+    level_dict = {
+        level: group.to_dict(orient="records") for level, group in df.groupby("level")
+    }
     logger.info(f"Perfis processados por nível: {level_dict.keys()}")
     return level_dict
 
 
-def calculate_and_store_risk(level_dict):
-    logger.info("Calculando risco para os perfis")
-    thresholds = {"High": 0.20, "Medium": 0.10}
-    min_players_required = 10
-    overall_risk_score = 0
-    total_players = 0
+def summarize_level(level, preds, num_players):
+    num_outliers = int(np.count_nonzero(preds == -1))
+    logger.info(
+        f"Nível {level}: {num_outliers} outliers encontrados em {num_players} jogadores"
+    )
+    return (num_outliers, num_players, num_outliers / num_players)
 
-    def process_level(level, players):
-        logger.info(f"Processando nível {level} com {len(players)} jogadores")
-        redis_players = fetch_players_from_redis(level)
-        combined_players = players + redis_players
-        logger.info(
-            f"Total de jogadores após combinar com Redis: {len(combined_players)}"
+
+async def analyze_levels(level_dict, client):
+    levels = list(level_dict)
+    sync_client = get_redis_client()
+    with sync_client.pipeline(transaction=False) as pipe:
+        for level in levels:
+            pipe.zcard(f"idx:level:{level}")
+        counts = pipe.execute()
+
+    # Níveis sem índice podem guardar histórico anterior ao índice; o reindex
+    # roda antes da elegibilidade (e independe do cache de modelo), senão um
+    # nível recém-migrado com poucos jogadores novos nunca seria varrido.
+    missing = [i for i, count in enumerate(counts) if count == 0]
+    if missing:
+        legacy = await asyncio.gather(
+            *(fetch_legacy_players(levels[i], client) for i in missing)
         )
-        if len(combined_players) >= min_players_required:
-            df = pd.DataFrame(combined_players)
-            outliers = apply_isolation_forest(df)
-            num_outliers = sum(1 for result in outliers if result["outlier"] == -1)
-            num_players = len(combined_players)
-            risk_score = num_outliers / num_players
-            save_players_to_redis(level, players)
-            logger.info(
-                f"Nível {level}: {num_outliers} outliers encontrados em {num_players} jogadores"
-            )
-            return (num_outliers, num_players, risk_score)
-        else:
+        for i, players in zip(missing, legacy):
+            counts[i] = len(players)
+
+    results = {}
+    eligible = []
+    for level, historical_count in zip(levels, counts):
+        players = level_dict[level]
+        logger.info(f"Processando nível {level} com {len(players)} jogadores")
+        if len(players) + historical_count < MIN_PLAYERS_REQUIRED:
             logger.warning(
                 f"Nível {level} não tem jogadores suficientes para aplicar o Isolation Forest"
             )
-            return (0, 0, 0)
+            results[level] = (0, 0, 0)
+        else:
+            eligible.append((level, players, len(players) + historical_count))
+
+    if eligible:
+        clf, fitted_levels = fetch_cached_model()
+        # O modelo só serve se cobre todos os níveis do request e nenhum deles
+        # cresceu mais de 20% desde o fit: como o nível é uma feature, um
+        # nível que o modelo nunca viu isolaria instantaneamente em todas as
+        # árvores e marcaria um lobby normal inteiro como outlier.
+        if clf is not None and all(
+            str(level) in fitted_levels
+            and total <= fitted_levels[str(level)] * MODEL_REFIT_GROWTH
+            for level, _, total in eligible
+        ):
+            logger.info("Reutilizando modelo em cache")
+            for level, players, _ in eligible:
+                preds = predict_with_model(clf, players, level)
+                results[level] = summarize_level(level, preds, len(players))
+        else:
+            fetched = await asyncio.gather(
+                *(fetch_players_from_redis(level, client) for level, _, _ in eligible)
+            )
+            combined = [
+                players + redis_players
+                for (_, players, _), redis_players in zip(eligible, fetched)
+            ]
+            # Um único fit para todos os níveis: o nível entra como feature e
+            # o custo fixo de construir a floresta é pago uma vez só.
+            X_all = np.concatenate(
+                [
+                    build_feature_matrix(players, level)
+                    for (level, _, _), players in zip(eligible, combined)
+                ]
+            )
+            logger.info(
+                f"Ajustando modelo único com {len(X_all)} jogadores de {len(eligible)} níveis"
+            )
+            # O fit é CPU-bound: vai para o pool de processos enquanto o event
+            # loop segue livre.
+            loop = asyncio.get_running_loop()
+            preds_all, clf = await loop.run_in_executor(
+                get_process_pool(), apply_isolation_forest, X_all
+            )
+            store_cached_model(
+                clf,
+                {
+                    str(level): len(players)
+                    for (level, _, _), players in zip(eligible, combined)
+                },
+            )
+
+            offsets = np.cumsum([len(players) for players in combined])[:-1]
+            # O risco é sempre calculado sobre os jogadores do request (que
+            # vêm primeiro em cada grupo), para que o mesmo payload receba o
+            # mesmo rótulo com cache quente ou frio.
+            for (level, players, _), preds in zip(
+                eligible, np.split(preds_all, offsets)
+            ):
+                results[level] = summarize_level(
+                    level, preds[: len(players)], len(players)
+                )
+
+        await asyncio.gather(
+            *(
+                save_players_to_redis(level, level_dict[level], client)
+                for level, _, _ in eligible
+            )
+        )
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        results = executor.map(lambda args: process_level(*args), level_dict.items())
+    return [results[level] for level in levels]
+
+
+async def calculate_and_store_risk(level_dict):
+    logger.info("Calculando risco para os perfis")
+    thresholds = {"High": 0.20, "Medium": 0.10}
+    overall_risk_score = 0
+    total_players = 0
+
+    # Cliente assíncrono só para os lotes de fetch/save; criado (e fechado)
+    # por request porque cada view async roda em seu próprio event loop.
+    client = redis.asyncio.Redis.from_url(
+        get_redis_url(), max_connections=32, decode_responses=True
+    )
+    try:
+        results = await analyze_levels(level_dict, client)
+    finally:
+        await client.aclose()
 
     for num_outliers, num_players, risk_score in results:
         if num_players:
@@ -102,64 +303,155 @@ def calculate_and_store_risk(level_dict):
         return "Low"
 
 
-def extract_and_process_profile_data(profile):
-    metrics = profile.get("metrics", {})
-    stats = metrics.get("stats", {})
-    data = {
-        "level": metrics.get("level"),
-        **{
-            k: stats.get(k, 0)
-            for k in [
-                "assists",
-                "clutches",
-                "deaths",
-                "firstKills",
-                "headshots",
-                "kddiff",
-                "kdr",
-                "adr",
-            ]
-        },
-    }
-    logger.debug(f"Dados processados para o jogador: {data}")
-    return data
+def parse_player(raw):
+    # Payloads atuais são JSON, mas chaves anteriores ao formato JSON foram
+    # gravadas como repr de dict; um registro ilegível não pode derrubar o
+    # request inteiro.
+    try:
+        return json.loads(raw)
+    except json.JSONDecodeError:
+        try:
+            return ast.literal_eval(raw)
+        except (ValueError, SyntaxError):
+            logger.warning(f"Payload de jogador ilegível ignorado: {raw[:80]!r}")
+            return None
 
 
-def fetch_players_from_redis(level):
+async def fetch_players_from_redis(level, client):
     logger.info(f"Buscando jogadores do nível {level} no Redis")
-    pattern = f"user:{level}:*"
-    keys = redis_client.keys(pattern)
+    steam_ids = await client.zrange(f"idx:level:{level}", 0, -1)
+    if not steam_ids:
+        return await fetch_legacy_players(level, client)
 
-    with redis_client.pipeline() as pipe:
-        for key in keys:
-            pipe.get(key)
-        players_data = pipe.execute()
+    players_data = await client.mget(
+        [f"user:{level}:{steam_id}" for steam_id in steam_ids]
+    )
 
-    players = [eval(player) for player in players_data if player]
+    players = [
+        player
+        for player in (parse_player(raw) for raw in players_data if raw)
+        if player is not None
+    ]
     logger.info(f"{len(players)} jogadores encontrados no Redis para o nível {level}")
     return players
 
 
-def save_players_to_redis(level, players):
-    expiration_time = 7 * 24 * 60 * 60  # 7 dias em segundos
-    for player in players:
-        steam_id = player.get("id")
-        if steam_id:
-            redis_key = f"user:{level}:{steam_id}"
-            redis_client.setex(redis_key, expiration_time, str(player))
+async def fetch_legacy_players(level, client):
+    # Chaves user:{level}:* gravadas antes do índice existir não aparecem no
+    # idx:level:{level}. O SCAN cursorizado com COUNT alto varre o keyspace sem
+    # bloquear o Redis (ao contrário do antigo KEYS) e o índice é repovoado
+    # para que os próximos requests voltem ao caminho rápido.
+    keys = [key async for key in client.scan_iter(match=f"user:{level}:*", count=1000)]
+    if not keys:
+        return []
+
+    players_data = await client.mget(keys)
+    players = [
+        player
+        for player in (parse_player(raw) for raw in players_data if raw)
+        if player is not None
+    ]
+
+    index_key = f"idx:level:{level}"
+    now = time.time()
+    async with client.pipeline(transaction=False) as pipe:
+        pipe.zadd(index_key, {key.rsplit(":", 1)[1]: now for key in keys})
+        pipe.zremrangebyrank(index_key, 0, -(MAX_PLAYERS_PER_LEVEL + 1))
+        pipe.expire(index_key, PLAYER_TTL)
+        await pipe.execute()
+    logger.info(f"{len(players)} jogadores legados reindexados para o nível {level}")
+    return players
+
+
+async def save_players_to_redis(level, players, client):
+    index_key = f"idx:level:{level}"
+    now = time.time()
+    async with client.pipeline(transaction=False) as pipe:
+        for player in players:
+            steam_id = player.get("id")
+            if steam_id:
+                redis_key = f"user:{level}:{steam_id}"
+                pipe.setex(redis_key, PLAYER_TTL, json.dumps(player))
+                pipe.zadd(index_key, {steam_id: now})
+        # Mantém apenas os MAX_PLAYERS_PER_LEVEL mais recentes no índice e
+        # descarta membros mais velhos que o TTL dos payloads; o EXPIRE cobre
+        # níveis que param de receber tráfego por completo.
+        pipe.zremrangebyrank(index_key, 0, -(MAX_PLAYERS_PER_LEVEL + 1))
+        pipe.zremrangebyscore(index_key, "-inf", now - PLAYER_TTL)
+        pipe.expire(index_key, PLAYER_TTL)
+        await pipe.execute()
     logger.info(f"Jogadores do nível {level} salvos no Redis")
 
 
-def apply_isolation_forest(df):
+def build_feature_matrix(players, level):
+    # Preenche coluna a coluna num buffer pré-alocado: uma passada curta por
+    # feature em vez de um gerador aninhado percorrendo dict por dict. A
+    # última coluna carrega o nível, já que o modelo é único para todos.
+    X = np.empty((len(players), len(FEATURE_COLS) + 1), dtype=np.float32)
+    for j, k in enumerate(FEATURE_COLS):
+        X[:, j] = np.fromiter(
+            (player.get(k, 0) for player in players), np.float32, len(players)
+        )
+    X[:, -1] = float(level)
+    return X
+
+
+# Floresta reutilizada entre fits dentro de cada worker do pool; estimadores
+# do sklearn não são thread-safe para fit concorrente, daí o lock. warm_start
+# não serve aqui: com n_estimators fixo o sklearn manteria as árvores antigas
+# em vez de reajustar aos dados novos.
+_forest = None
+_forest_lock = threading.Lock()
+
+
+def apply_isolation_forest(X):
+    global _forest
     logger.info("Aplicando Isolation Forest")
-    clf = IsolationForest(
-        n_estimators=50, contamination="auto"
-    )  # Reduzi para 50 estimadores para otimização
-    df["outlier"] = clf.fit_predict(df.drop(columns=["level"]))
+    with _forest_lock:
+        if _forest is None:
+            _forest = IsolationForest(
+                n_estimators=100,
+                contamination="auto",
+                n_jobs=-1,
+                bootstrap=False,
+            )
+        # ψ=256 é a subamostra recomendada no paper original do Isolation
+        # Forest; o min() evita o aviso do sklearn em bases menores que isso.
+        _forest.set_params(max_samples=min(256, len(X)))
+        preds = _forest.fit_predict(X)
     logger.info(
-        f"Isolation Forest aplicado. Outliers identificados: {sum(df['outlier'] == -1)}"
+        f"Isolation Forest aplicado. Outliers identificados: {int(np.count_nonzero(preds == -1))}"
     )
-    return df.to_dict(orient="records")
+    return preds, _forest
+
+
+def predict_with_model(clf, players, level):
+    scores = clf.decision_function(build_feature_matrix(players, level))
+    return np.where(scores < 0, -1, 1)
+
+
+def fetch_cached_model():
+    cached = get_redis_client().get(MODEL_CACHE_KEY)
+    if not cached:
+        return None, {}
+    try:
+        payload = json.loads(cached)
+        clf = pickle.loads(base64.b64decode(payload["model"]))
+        return clf, payload["levels"]
+    except Exception:
+        logger.warning("Modelo em cache inválido, reajustando")
+        return None, {}
+
+
+def store_cached_model(clf, level_counts):
+    # level_counts registra com quantos jogadores cada nível foi ajustado,
+    # para o check de cobertura/crescimento na reutilização do cache.
+    payload = {
+        "levels": level_counts,
+        "model": base64.b64encode(pickle.dumps(clf)).decode("ascii"),
+    }
+    get_redis_client().setex(MODEL_CACHE_KEY, MODEL_CACHE_TTL, json.dumps(payload))
+    logger.info(f"Modelo salvo no Redis (níveis: {sorted(level_counts)})")
 
 
 if __name__ == "__main__":